@@ -2,5 +2,6 @@ from availtgbot.billing import Billing, BillingItem, BillingStatus, Status
 from availtgbot.bot import Bot
 from availtgbot.checker import AvailChecker
 from availtgbot.monitor import Monitor
+from availtgbot.storage import Storage, SQLiteStorage, PostgresStorage
 
-__all__ = ['billing', 'bot', 'checker', 'monitor']
+__all__ = ['billing', 'bot', 'checker', 'monitor', 'storage']
@@ -30,11 +30,18 @@ def main():
     parser.add_argument('token', type=str
                         ,help='Your telegram API token.')
     parser.add_argument('-d', '--database', type=str, default=':memory:'
-                        , help='Minimum interval between URL checks in sec. If not specified, in-memory storage used.')
+                        , help='SQLite database path or PostgreSQL URL. If not specified, in-memory storage used.')
     parser.add_argument("-i", "--interval", type=int, default=10
                         , help='Default interval between URL checks in sec.')
     parser.add_argument("-m", "--minimum", type=int, default=5
                         , help='Minimum interval between URL checks in sec.')
+    parser.add_argument("-c", "--capacity", type=int, default=None
+                        , help='Maximum URL checks started per second, shared fairly between users. Unlimited by default.')
+    parser.add_argument("-q", "--quota", type=int, default=None
+                        , help='Default maximum number of monitored URLs per user.')
+    parser.add_argument("-r", "--rate", type=int, default=None
+                        , help='Default maximum URL checks per minute per user. By default allows checking' +
+                               ' all URLs at the minimum interval.')
     parser.add_argument("-v", "--verbose", action="count"
                         , help='Output level with corresponding verbosity: -v, -vv, -vvv .')
 
@@ -50,7 +57,8 @@ def main():
     for sig in [SIGINT, SIGTERM, SIGABRT]:
         signal(sig, signal_handler)
 
-    __tbot__ = Bot(token=args.token, db_path=args.database, default_delay=args.interval, min_delay=args.minimum)
+    __tbot__ = Bot(token=args.token, db_path=args.database, default_delay=args.interval, min_delay=args.minimum,
+                   capacity=args.capacity, max_items=args.quota, max_checks_per_minute=args.rate)
     __tbot__.start()
 
     while __is_idle__:
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, PickleType, DateTime, pool, create_engine
+from sqlalchemy import Column, Integer, BigInteger, String, PickleType, DateTime, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session
 from enum import Enum
@@ -6,6 +6,8 @@ import pickle
 import datetime
 import logging
 
+from availtgbot import storage
+
 __Base__ = declarative_base()
 
 
@@ -14,13 +16,15 @@ class BillingItem(__Base__):
     __tablename__ = "monitoritems"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(String)
+    user_id = Column(BigInteger)
     name = Column(String)
     url = Column(PickleType)
     delay = Column(Integer)
     offset = Column(Integer)
     last_check = Column(DateTime, nullable=True)
     last_status = Column(Integer, default=0)
+    # Unix time of the last check round that claimed this item, so each item is checked by one process only
+    claimed_at = Column(Integer, nullable=True)
 
     def get_parsed_url(self):
         return pickle.loads(self.url)
@@ -47,12 +51,17 @@ class BillingStatus(__Base__):
     __tablename__ = "sessionstatus"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer)
+    user_id = Column(BigInteger)
     status = Column(Integer, default=0)
     extra_info = Column(PickleType, nullable=True)
+    max_items = Column(Integer, nullable=True)
+    max_checks_per_minute = Column(Integer, nullable=True)
+    weight = Column(Integer, default=1)
 
     def __repr__(self):
-        return "<BillingStatus(id=%s, user_id='%s', status='%s')>" % (self.id, self.user_id, self.status)
+        return ("<BillingStatus(id=%s, user_id='%s', status='%s', max_items=%s, max_checks_per_minute=%s," +
+                " weight=%s)>") % (self.id, self.user_id, self.status, self.max_items, self.max_checks_per_minute,
+                                   self.weight)
 
 # Singleton for dealing with all the DB-related stuff. Manages monitored items and user sessions.
 class Billing:
@@ -69,41 +78,88 @@ class Billing:
         def __init__(self, user_id, name):
             self.message = "Monitor item with name " + name + " not found for user " + str(user_id)
 
+    class ItemQuotaExceededError(Exception):
+        def __init__(self, user_id, max_items):
+            self.message = "User " + str(user_id) + " can't monitor more than " + str(max_items) + " items"
+
+    # Quotas applied to users that have no personal limits set in their session.
+    # Checks per minute allow DEFAULT_MAX_ITEMS items to be checked every 5 sec, the default minimum delay.
+    DEFAULT_MAX_ITEMS = 20
+    DEFAULT_MAX_CHECKS_PER_MINUTE = 240
+
+    storage = None
     engine = None
     logger = None
-    def __init__(self, path):
+    # path is either SQLite database path or a database URL, see availtgbot.storage.create_storage
+    # max_items and max_checks_per_minute are quotas for users without personal limits
+    def __init__(self, path, max_items=None, max_checks_per_minute=None):
+        self.max_items = max_items if max_items is not None else Billing.DEFAULT_MAX_ITEMS
+        self.max_checks_per_minute = max_checks_per_minute if max_checks_per_minute is not None \
+            else Billing.DEFAULT_MAX_CHECKS_PER_MINUTE
         if Billing.engine is None:
             Billing.logger = logging.getLogger('availtgbot.billing.Billing')
-            Billing.engine = create_engine('sqlite:///{}'.format(path), echo=False,
-                                           connect_args={'check_same_thread': False},
-                                           poolclass=pool.StaticPool)
+            Billing.storage = storage.create_storage(path)
+            Billing.engine = Billing.storage.engine
             __Base__.metadata.create_all(Billing.engine, checkfirst=True)
+            Billing._migrate()
+
+    # Add columns that are missing in tables created by an older version. create_all doesn't alter existing tables
+    @staticmethod
+    def _migrate():
+        inspector = inspect(Billing.engine)
+        quote = Billing.engine.dialect.identifier_preparer.quote
+        with Billing.engine.begin() as connection:
+            for table in __Base__.metadata.sorted_tables:
+                existing = [x['name'] for x in inspector.get_columns(table.name)]
+                for column in table.columns:
+                    if column.name not in existing:
+                        Billing.logger.warning("Adding missing column %s.%s", table.name, column.name)
+                        connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                            quote(table.name), quote(column.name),
+                            column.type.compile(dialect=Billing.engine.dialect))))
 
     # Monitor item table methods
 
     # Check if item exists for user
     def item_exists(self, user_id, name):
         Billing.logger.debug("Item exists request for user: %d, item: %s", user_id, name)
-        session = Session(Billing.engine)
-        item = session.query(BillingItem).filter_by(user_id=user_id, name=name)
-        return item.count() > 0
-
-    # Get all monitored items
-    def get_monitor_items(self):
-        Billing.logger.debug("All monitored items request")
-        return Session(Billing.engine).query(BillingItem).all()
-
-    # Add a new item for user
+        with Session(Billing.engine) as session:
+            return session.query(BillingItem).filter_by(user_id=user_id, name=name).count() > 0
+
+    # Get the subset of item_ids that still exist
+    def get_existing_item_ids(self, item_ids):
+        Billing.logger.debug("Existing items request: %d items", len(item_ids))
+        with Session(Billing.engine) as session:
+            return {x[0] for x in session.query(BillingItem.id).filter(BillingItem.id.in_(item_ids))}
+
+    # Claim and get all items due for a check at m_time (unix time in sec) that no other process claimed yet
+    def get_due_items(self, m_time):
+        Billing.logger.debug("Due monitored items request: time: %d", m_time)
+        return Billing.storage.fetch_due_items(m_time)
+
+    # Apply a batch of check results: list of (item_id, status, check_time)
+    def update_items_status(self, updates):
+        Billing.logger.debug("Updating statuses of %d items", len(updates))
+        Billing.storage.apply_status_updates(updates)
+
+    # Add a new item for user. Checks and insert run in one write transaction (the user's session row is locked on
+    # PostgreSQL, the whole database on SQLite), so concurrent adds can't go over the quota
     def add_user_item(self, user_id, name, url, delay, offset):
         Billing.logger.debug("Add monitor item request: user_id: %d, name: %s", user_id, name)
-        if self.item_exists(user_id, name):
-            Billing.logger.debug("Can't add item with name already exists: user_id: %d, name: %s", user_id, name)
-            raise Billing.MonitorItemNameExistsError(user_id, name)
-
-        log = BillingItem(user_id=user_id, name=name, url=pickle.dumps(url), delay=delay, offset=offset)
-        session = Session(Billing.engine)
-        session.add(log)
-        session.commit()
+        with Session(Billing.engine) as session:
+            Billing.storage.begin_write(session)
+            owner = session.query(BillingStatus).filter_by(user_id=user_id).with_for_update().first()
+            if session.query(BillingItem).filter_by(user_id=user_id, name=name).count() > 0:
+                Billing.logger.debug("Can't add item with name already exists: user_id: %d, name: %s", user_id, name)
+                raise Billing.MonitorItemNameExistsError(user_id, name)
+
+            max_items = self._quota_of(owner)[0] if owner else self.max_items
+            if session.query(BillingItem).filter_by(user_id=user_id).count() >= max_items:
+                Billing.logger.debug("Can't add item over quota: user_id: %d, max_items: %d", user_id, max_items)
+                raise Billing.ItemQuotaExceededError(user_id, max_items)
+
+            session.add(BillingItem(user_id=user_id, name=name, url=pickle.dumps(url), delay=delay, offset=offset))
+            session.commit()
 
     # Get all monitored items for a particular user
     def get_user_items_list(self, user_id):
@@ -112,8 +168,9 @@ class Billing:
             Billing.logger.debug("User not found: user_id: %d")
             raise Billing.UserNotFoundError(user_id)
 
-        items = Session(Billing.engine).query(BillingItem).filter_by(user_id=user_id)
-        return [(x.name, pickle.loads(x.url), x.delay) for x in items]
+        with Session(Billing.engine) as session:
+            items = session.query(BillingItem).filter_by(user_id=user_id)
+            return [(x.name, pickle.loads(x.url), x.delay) for x in items]
 
     # Get all items' statuses for a user
     def get_user_items_status(self, user_id):
@@ -122,8 +179,9 @@ class Billing:
             Billing.logger.debug("User not found: user_id: %d")
             raise Billing.UserNotFoundError(user_id)
 
-        items = Session(Billing.engine).query(BillingItem).filter_by(user_id=user_id)
-        return [(x.name, x.last_status, x.last_check) for x in items]
+        with Session(Billing.engine) as session:
+            items = session.query(BillingItem).filter_by(user_id=user_id)
+            return [(x.name, x.last_status, x.last_check) for x in items]
 
     # Update information on some user item
     def update_user_item(self, user_id, name, delay=None, status=None, offset=None):
@@ -132,16 +190,16 @@ class Billing:
             Billing.logger.debug("User item not found: user_id: %d, name: %s", user_id, name)
             raise Billing.MonitorItemNotFoundError(user_id, name)
 
-        session = Session(Billing.engine)
-        item = session.query(BillingItem).filter_by(user_id=user_id, name=name).first()
-        if delay:
-            item.delay = delay
-        if status:
-            item.last_status = status
-            item.last_check = datetime.datetime.now()
-        if offset:
-            item.offset = offset
-        session.commit()
+        with Session(Billing.engine) as session:
+            item = session.query(BillingItem).filter_by(user_id=user_id, name=name).first()
+            if delay:
+                item.delay = delay
+            if status:
+                item.last_status = status
+                item.last_check = datetime.datetime.now()
+            if offset:
+                item.offset = offset
+            session.commit()
 
     # Remove a monitored item for a specified user
     def remove_user_item(self,user_id, name):
@@ -149,18 +207,18 @@ class Billing:
         if not self.item_exists(user_id, name):
             Billing.logger.debug("User item not found: user_id: %d, name: %s", user_id, name)
             raise Billing.MonitorItemNotFoundError(user_id, name)
-        session = Session(Billing.engine)
-        item = session.query(BillingItem).filter_by(user_id=user_id, name=name).first()
-        session.delete(item)
-        session.commit()
+        with Session(Billing.engine) as session:
+            item = session.query(BillingItem).filter_by(user_id=user_id, name=name).first()
+            session.delete(item)
+            session.commit()
 
     # Session table methods
 
     # Check if user is already registered in the system
     def session_exists(self, user_id):
         Billing.logger.debug("Checking if user session exists: user_id: %d", user_id)
-        item = Session(Billing.engine).query(BillingStatus).filter_by(user_id=user_id)
-        return item.count() > 0
+        with Session(Billing.engine) as session:
+            return session.query(BillingStatus).filter_by(user_id=user_id).count() > 0
 
 
     # Get all information about user session
@@ -170,27 +228,63 @@ class Billing:
             Billing.logger.debug("User not found: user_id: %d", user_id)
             raise Billing.UserNotFoundError(user_id)
 
-        session = Session(Billing.engine)
-        item = session.query(BillingStatus).filter_by(user_id=user_id).first()
-        return item
+        with Session(Billing.engine) as session:
+            return session.query(BillingStatus).filter_by(user_id=user_id).first()
 
     # Ad a new user to the system
     def add_session(self, user_id):
         Billing.logger.debug("adding new user: user_id: %d", user_id)
         if not self.session_exists(user_id):
 
-            session = Session(Billing.engine)
-            item = BillingStatus(user_id=user_id)
-            session.add(item)
-            session.commit()
+            with Session(Billing.engine) as session:
+                session.add(BillingStatus(user_id=user_id))
+                session.commit()
 
     # Update user's session status
     def update_session(self, user_id, status, info=None):
         Billing.logger.debug("Updating user session: user_id: %d, status: %s", user_id, status.name)
         if not self.session_exists(user_id):
             raise Billing.UserNotFoundError(user_id)
-        session = Session(Billing.engine)
-        item = session.query(BillingStatus).filter_by(user_id=user_id).first()
-        item.status = status.value
-        item.extra_info = pickle.dumps(info)
-        session.commit()
+        with Session(Billing.engine) as session:
+            item = session.query(BillingStatus).filter_by(user_id=user_id).first()
+            item.status = status.value
+            item.extra_info = pickle.dumps(info)
+            session.commit()
+
+    # Quota methods
+
+    # Get (max_items, max_checks_per_minute, weight) for a user, falling back to defaults for unset values
+    def get_user_quota(self, user_id):
+        Billing.logger.debug("Getting user quota: user_id: %d", user_id)
+        with Session(Billing.engine) as session:
+            item = session.query(BillingStatus).filter_by(user_id=user_id).first()
+        if item is None:
+            return self.max_items, self.max_checks_per_minute, 1
+        return self._quota_of(item)
+
+    # Get quotas of all registered users in one query: {str(user_id): (max_items, max_checks_per_minute, weight)}
+    def get_user_quotas(self):
+        Billing.logger.debug("All user quotas request")
+        with Session(Billing.engine) as session:
+            return {str(x.user_id): self._quota_of(x) for x in session.query(BillingStatus).all()}
+
+    # Set personal quotas for a user. Values left as None are not changed
+    def update_user_quota(self, user_id, max_items=None, max_checks_per_minute=None, weight=None):
+        Billing.logger.debug("Updating user quota: user_id: %d", user_id)
+        if not self.session_exists(user_id):
+            raise Billing.UserNotFoundError(user_id)
+        with Session(Billing.engine) as session:
+            item = session.query(BillingStatus).filter_by(user_id=user_id).first()
+            if max_items is not None:
+                item.max_items = max_items
+            if max_checks_per_minute is not None:
+                item.max_checks_per_minute = max_checks_per_minute
+            if weight is not None:
+                item.weight = weight
+            session.commit()
+
+    # Quota tuple of a session row with defaults applied
+    def _quota_of(self, item):
+        return (item.max_items if item.max_items is not None else self.max_items,
+                item.max_checks_per_minute if item.max_checks_per_minute is not None else self.max_checks_per_minute,
+                item.weight or 1)
@@ -11,12 +11,19 @@ from availtgbot.billing import Status
 
 
 class Bot(object):
-    def __init__(self, token, db_path=":memory:", default_delay=10, min_delay=5):
+    def __init__(self, token, db_path=":memory:", default_delay=10, min_delay=5, capacity=None, max_items=None,
+                 max_checks_per_minute=None):
 
         self.default_delay = default_delay
         self.min_delay = min_delay
-        self.billing = billing.Billing(db_path)
-        self.monitor = monitor.Monitor(self._status_updated, db_path)
+        # By default users may check all of their items at the minimum delay
+        if max_items is None:
+            max_items = billing.Billing.DEFAULT_MAX_ITEMS
+        if max_checks_per_minute is None:
+            max_checks_per_minute = -(-max_items * 60 // min_delay)
+        self.billing = billing.Billing(db_path, max_items, max_checks_per_minute)
+        self.monitor = monitor.Monitor(self._status_updated, db_path, capacity, self._checks_throttled, max_items,
+                                       max_checks_per_minute)
 
         self.logger = logging.getLogger('availtgbot.bot.Bot')
 
@@ -114,6 +121,11 @@ class Bot(object):
                 self.billing.update_session(user_id, Status.STATUS_IDLE)
                 bot.sendMessage(chat_id=user_id, text="URL with this associated name already exists. Not added.")
                 self._send_status(bot, user_id)
+            except billing.Billing.ItemQuotaExceededError as e:
+                self.logger.debug("Tried to add a URL over the quota: %s", e.message)
+                self.billing.update_session(user_id, Status.STATUS_IDLE)
+                bot.sendMessage(chat_id=user_id, text="You have reached the limit of monitored URLs. Not added.")
+                self._send_status(bot, user_id)
 
         elif status is Status.STATUS_REMOVE_NAME:
             text = update.message.text
@@ -297,3 +309,11 @@ class Bot(object):
                                                                 "Response:\t{2}\n")
                                          .format(item.name, url, status),
                                          disable_web_page_preview=True, parse_mode="Markdown")
+
+    # Callback called by self.monitor when user's checks are delayed by the checks-per-minute quota
+    def _checks_throttled(self, user_id, max_checks_per_minute):
+        self.logger.debug("Sending Throttling message to %s", user_id)
+        self.updater.bot.sendMessage(chat_id=user_id, text=str("*Notification:* your URL checks are delayed.\n" +
+                                                               "You can't have more than {} checks per minute." +
+                                                               " Please increase check delays or remove some URLs.")
+                                     .format(max_checks_per_minute), parse_mode="Markdown")
@@ -1,4 +1,6 @@
-from threading import Thread
+from collections import deque, OrderedDict
+from threading import Thread, Lock
+import datetime
 import logging
 import sched
 import time
@@ -25,12 +27,127 @@ class RepeatScheduler(object):
         self.scheduler.cancel(self.eventID)
 
 
+# Fair-share scheduler for URL checks. Due items are queued per user and dispatched in weighted round-robin
+# order, so one heavy user can only consume its own share of the global check capacity.
+# capacity of None means unlimited. default_quota is applied to users missing from quotas passed to dispatch,
+# if it's None such users are not limited by checks per minute.
+class FairScheduler(object):
+    def __init__(self, capacity=None, default_quota=None):
+        self.capacity = capacity
+        self.default_quota = default_quota
+        self.queues = OrderedDict()
+        self.pending = set()
+        self.history = {}
+        self.lag = {}
+        self.throttled = set()
+        self.lock = Lock()
+
+    # Queue an item that became due at `due` time. Items that are still waiting or being checked are not queued
+    # twice, see complete
+    def enqueue(self, item, due):
+        with self.lock:
+            if item.id in self.pending:
+                return
+            self.pending.add(item.id)
+            self.queues.setdefault(str(item.user_id), deque()).append((due, item))
+
+    # Pick items to check this round with respect to global capacity and per-user checks-per-minute quotas.
+    # quotas is {user_id: (max_items, max_checks_per_minute, weight)}, as returned by Billing.get_user_quotas
+    def dispatch(self, quotas, now=None):
+        if now is None:
+            now = time.time()
+        dispatched = []
+        with self.lock:
+            allowance = {}
+            for user_id in self.queues:
+                history = self.history.setdefault(user_id, deque())
+                while history and history[0] <= now - 60:
+                    history.popleft()
+                quota = quotas.get(user_id, self.default_quota)
+                allowance[user_id] = quota[1] - len(history) if quota else len(self.queues[user_id])
+
+            progress = True
+            while progress and self._has_capacity(dispatched):
+                progress = False
+                for user_id, queue in self.queues.items():
+                    quota = quotas.get(user_id, self.default_quota)
+                    share = quota[2] if quota else 1
+                    while share > 0 and queue and allowance[user_id] > 0 and self._has_capacity(dispatched):
+                        due, item = queue.popleft()
+                        self.history[user_id].append(now)
+                        self._record_lag(user_id, now - due)
+                        dispatched.append(item)
+                        allowance[user_id] -= 1
+                        share -= 1
+                        progress = True
+
+            # Users left with queued items because their checks-per-minute quota is exhausted
+            self.throttled = {x for x, queue in self.queues.items() if queue and allowance[x] <= 0}
+
+            # Rotate users so the one served first this round is served last in the next one
+            for user_id in list(self.queues):
+                if not self.queues[user_id]:
+                    del self.queues[user_id]
+            if self.queues:
+                self.queues.move_to_end(next(iter(self.queues)))
+        return dispatched
+
+    # Mark items as checked once their results are recorded, so they can be queued again
+    def complete(self, item_ids):
+        with self.lock:
+            self.pending.difference_update(item_ids)
+
+    # Ids of all items waiting in the queue
+    def get_queued_ids(self):
+        with self.lock:
+            return [x[1].id for queue in self.queues.values() for x in queue]
+
+    # Drop queued items which are not in item_ids, e.g. removed by the user while waiting in the queue
+    def retain(self, item_ids):
+        with self.lock:
+            for user_id, queue in self.queues.items():
+                self.pending.difference_update(x[1].id for x in queue if x[1].id not in item_ids)
+                self.queues[user_id] = deque(x for x in queue if x[1].id in item_ids)
+
+    # Scheduling lag statistics for every user that was dispatched or has queued items:
+    # {user_id: {'last': sec, 'avg': sec, 'max': sec, 'checks': n, 'queued': n, 'oldest': sec}}
+    # last/avg/max are lags of dispatched checks, oldest is the age of the oldest item still waiting in the queue
+    def get_lag_stats(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            stats = {}
+            for user_id in set(self.lag) | set(self.queues):
+                lag = self.lag.get(user_id, [0, 0, 0, 0])
+                queue = self.queues.get(user_id)
+                stats[user_id] = {'last': lag[0], 'avg': lag[1] / lag[3] if lag[3] else 0, 'max': lag[2],
+                                  'checks': lag[3], 'queued': len(queue) if queue else 0,
+                                  'oldest': now - queue[0][0] if queue else 0}
+            return stats
+
+    def _has_capacity(self, dispatched):
+        return self.capacity is None or len(dispatched) < self.capacity
+
+    def _record_lag(self, user_id, lag):
+        stats = self.lag.setdefault(user_id, [0, 0, 0, 0])
+        stats[0] = lag
+        stats[1] += lag
+        stats[2] = max(stats[2], lag)
+        stats[3] += 1
+
+
 # Monitor organizes the checking procedure for all URLs and updates database with results.
 class Monitor:
-    def __init__(self, check_handler, db_path=":memory:"):
-        self.billing = billing.Billing(db_path)
+    def __init__(self, check_handler, db_path=":memory:", capacity=None, throttle_handler=None, max_items=None,
+                 max_checks_per_minute=None):
+        self.billing = billing.Billing(db_path, max_items, max_checks_per_minute)
         self.check_handler = check_handler
+        self.throttle_handler = throttle_handler
+        self.throttled = set()
         self.repeat_scheduler = RepeatScheduler()
+        self.fair_scheduler = FairScheduler(capacity, (self.billing.max_items, self.billing.max_checks_per_minute, 1))
+        self.status_updates = []
+        self.status_lock = Lock()
         self.running = False
         self.logger = logging.getLogger('availtgbot.monitor.Monitor')
 
@@ -46,26 +163,78 @@ class Monitor:
     def stop(self):
         self.logger.debug("Stopping the monitor")
         self.repeat_scheduler.stop()
+        self._flush_status_updates()
         self.running = False
         self.logger.debug("Monitor stopped")
 
-    # Runs through all the items stored in the DB and starts a checker for each
+    # Scheduling lag per user, see FairScheduler.get_lag_stats
+    def get_lag_stats(self):
+        return self.fair_scheduler.get_lag_stats()
+
+    # Runs a check round. Errors are logged so that the next round is still scheduled
     def _check_items(self):
         self.logger.debug("Running URL check round")
-        for item in self.billing.get_monitor_items():
-            if self._should_check(item):
-                thread = Thread(target=checker.AvailChecker.check_url, args=(item, self._update_status_handler))
-                thread.start()
+        try:
+            self._flush_status_updates()
+            self._run_checks()
+        except Exception:
+            self.logger.exception("URL check round failed")
+
+    # Queues items that are due, starts a checker for each scheduled item and reports throttled users
+    def _run_checks(self):
+        m_time = int(time.time())
+        for item in self.billing.get_due_items(m_time):
+            self.fair_scheduler.enqueue(item, m_time)
 
-    # Once checker finishes this method is called to calculate results
+        # Items may have been removed by their users while waiting in the queue
+        queued = self.fair_scheduler.get_queued_ids()
+        if queued:
+            self.fair_scheduler.retain(self.billing.get_existing_item_ids(queued))
+
+        quotas = self.billing.get_user_quotas()
+        for item in self.fair_scheduler.dispatch(quotas):
+            thread = Thread(target=checker.AvailChecker.check_url, args=(item, self._update_status_handler))
+            thread.start()
+
+        # Notify users once when their checks start to be delayed by the checks-per-minute quota
+        throttled = set(self.fair_scheduler.throttled)
+        if self.throttle_handler:
+            for user_id in throttled - self.throttled:
+                limit = quotas.get(user_id, self.fair_scheduler.default_quota)[1]
+                Thread(target=self._notify_throttled, args=(user_id, limit)).start()
+        self.throttled = throttled
+
+        for user_id, stats in self.get_lag_stats().items():
+            if stats['queued']:
+                self.logger.debug("Scheduling lag for user %s: last %.1fs, avg %.1fs, max %.1fs, %d queued" +
+                                  " (oldest %.1fs)", user_id, stats['last'], stats['avg'], stats['max'],
+                                  stats['queued'], stats['oldest'])
+
+    # Once checker finishes this method is called to calculate results. DB update is deferred to the next round,
+    # until then the item is kept out of the scheduler so it's not re-queued with a stale last_status
     def _update_status_handler(self, item, status):
         changed = item.last_status != status
-        self.billing.update_user_item(item.user_id, item.name, status=status)
+        with self.status_lock:
+            self.status_updates.append((item.id, status, datetime.datetime.now()))
         self.check_handler(item, status, changed)
 
-    # Returns whether a specific URL is to be checked in this round
-    @staticmethod
-    def _should_check(item, m_time=None):
-        if m_time is None:
-            m_time = int(time.time())
-        return (m_time - item.offset) % item.delay == 0
+    # Calls throttle_handler outside of the scheduler thread, as sending a message may fail or take long
+    def _notify_throttled(self, user_id, max_checks_per_minute):
+        try:
+            self.throttle_handler(user_id, max_checks_per_minute)
+        except Exception:
+            self.logger.exception("Throttling notification failed for user %s", user_id)
+
+    # Write all check results collected since the previous round in one batch. On failure they are kept for retry
+    def _flush_status_updates(self):
+        with self.status_lock:
+            updates, self.status_updates = self.status_updates, []
+        if updates:
+            try:
+                self.billing.update_items_status(updates)
+            except Exception:
+                self.logger.exception("Failed to store %d check results", len(updates))
+                with self.status_lock:
+                    self.status_updates = updates + self.status_updates
+                return
+            self.fair_scheduler.complete([x[0] for x in updates])
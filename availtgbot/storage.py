@@ -0,0 +1,106 @@
+from sqlalchemy import create_engine, event, bindparam, pool, select, update, and_, or_
+from sqlalchemy.orm import Session
+import logging
+
+from availtgbot import billing
+
+
+# Storage backend used by Billing: builds the engine with a connection pool suited to the database and provides
+# bulk query paths for the monitor, so that a check round costs a fixed number of queries regardless of the
+# number of items. Regular item and session queries are done by Billing through the engine.
+class Storage(object):
+
+    logger = logging.getLogger('availtgbot.storage.Storage')
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    # Claim all items due for a check at m_time (unix time in sec) and return them. An item is claimed only once
+    # per m_time, so several processes sharing the database don't check the same item twice
+    def fetch_due_items(self, m_time):
+        Storage.logger.debug("Due items request: time: %d", m_time)
+        table = billing.BillingItem.__table__
+        with self.engine.begin() as connection:
+            ids = [x[0] for x in connection.execute(self._claim_statement(table, m_time))]
+        if not ids:
+            return []
+        with Session(self.engine) as session:
+            return session.query(billing.BillingItem).filter(billing.BillingItem.id.in_(ids)).all()
+
+    # Apply a batch of (item_id, status, check_time) updates in a single executemany statement
+    def apply_status_updates(self, updates):
+        Storage.logger.debug("Applying %d status updates", len(updates))
+        if not updates:
+            return
+        table = billing.BillingItem.__table__
+        statement = table.update().where(table.c.id == bindparam('b_id')) \
+            .values(last_status=bindparam('b_status'), last_check=bindparam('b_check'))
+        with self.engine.begin() as connection:
+            connection.execute(statement, [{'b_id': x[0], 'b_status': x[1], 'b_check': x[2]} for x in updates])
+
+    # Start a transaction in session that is serialized with other writers. On PostgreSQL rows are locked
+    # by SELECT ... FOR UPDATE inside the transaction, so nothing has to be done here
+    def begin_write(self, session):
+        pass
+
+    # UPDATE ... RETURNING statement that claims due items for m_time
+    def _claim_statement(self, table, m_time):
+        return update(table).where(self._due_clause(table, m_time)).values(claimed_at=m_time).returning(table.c.id)
+
+    @staticmethod
+    def _due_clause(table, m_time):
+        return and_((m_time - table.c.offset) % table.c.delay == 0,
+                    or_(table.c.claimed_at.is_(None), table.c.claimed_at < m_time))
+
+
+# SQLite storage. File databases run in WAL mode with a connection pool, so readers don't block the writer.
+# In-memory databases exist per connection and therefore keep a single shared connection.
+class SQLiteStorage(Storage):
+    def __init__(self, path=":memory:", pool_size=5, max_overflow=10, busy_timeout=5000):
+        if path == ":memory:":
+            engine = create_engine('sqlite://', echo=False, connect_args={'check_same_thread': False},
+                                   poolclass=pool.StaticPool)
+        else:
+            engine = create_engine('sqlite:///{}'.format(path), echo=False,
+                                   connect_args={'check_same_thread': False},
+                                   poolclass=pool.QueuePool, pool_size=pool_size, max_overflow=max_overflow)
+
+            @event.listens_for(engine, "connect")
+            def _set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+                cursor.execute("PRAGMA busy_timeout={}".format(busy_timeout))
+                cursor.close()
+
+        super(SQLiteStorage, self).__init__(engine)
+
+    # SQLite ignores FOR UPDATE and pysqlite starts transactions lazily on the first write, so reads done before
+    # it are not isolated from other writers. BEGIN IMMEDIATE takes the database write lock up front
+    def begin_write(self, session):
+        driver_connection = session.connection().connection.driver_connection
+        if not driver_connection.in_transaction:
+            driver_connection.execute("BEGIN IMMEDIATE")
+
+
+# PostgreSQL storage with a real connection pool. Allows several bot processes to share the same data.
+# Requires a PostgreSQL DB-API driver supported by SQLAlchemy, selected by the URL, e.g. postgresql+psycopg://
+class PostgresStorage(Storage):
+    def __init__(self, url, pool_size=10, max_overflow=20, pool_timeout=30):
+        engine = create_engine(url, echo=False, poolclass=pool.QueuePool, pool_size=pool_size,
+                               max_overflow=max_overflow, pool_timeout=pool_timeout, pool_pre_ping=True)
+        super(PostgresStorage, self).__init__(engine)
+
+    # Rows locked by a concurrent claim are skipped instead of waited for
+    def _claim_statement(self, table, m_time):
+        due = select(table.c.id).where(self._due_clause(table, m_time)).with_for_update(skip_locked=True)
+        return update(table).where(table.c.id.in_(due)).values(claimed_at=m_time).returning(table.c.id)
+
+
+# Create a storage for a database path or URL: 'postgresql://...' URLs use PostgreSQL, everything else SQLite
+def create_storage(path):
+    if path.startswith('postgresql'):
+        return PostgresStorage(path)
+    if path.startswith('sqlite:///'):
+        path = path[len('sqlite:///'):] or ":memory:"
+    return SQLiteStorage(path)
@@ -0,0 +1,46 @@
+import pytest
+
+from availtgbot.billing import Billing, BillingItem
+
+
+# Billing keeps its engine on the class, so every test gets a fresh one
+def _reset_billing(drop=False):
+    if Billing.engine is not None:
+        if drop:
+            BillingItem.metadata.drop_all(Billing.engine)
+        Billing.engine.dispose()
+    Billing.engine = None
+    Billing.storage = None
+
+
+# Embedded PostgreSQL server shared by the whole test session
+@pytest.fixture(scope="session")
+def postgres_url(tmp_path_factory):
+    pgserver = pytest.importorskip("pgserver")
+    pytest.importorskip("psycopg")
+    server = pgserver.get_server(str(tmp_path_factory.mktemp("pgdata")), cleanup_mode="stop")
+    yield server.get_uri().replace("postgresql://", "postgresql+psycopg://", 1)
+    server.cleanup()
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    _reset_billing()
+    yield str(tmp_path / "availtgbot.db")
+    _reset_billing()
+
+
+# Database path for every supported backend: SQLite file database and PostgreSQL
+@pytest.fixture(params=["sqlite", "postgresql"])
+def db_path(request, tmp_path):
+    _reset_billing()
+    if request.param == "sqlite":
+        yield str(tmp_path / "availtgbot.db")
+    else:
+        yield request.getfixturevalue("postgres_url")
+    _reset_billing(drop=True)
+
+
+@pytest.fixture
+def billing(db_path):
+    return Billing(db_path)
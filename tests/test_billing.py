@@ -0,0 +1,122 @@
+from threading import Thread
+from urllib.parse import urlsplit
+
+from sqlalchemy import create_engine, inspect, text
+import pytest
+
+from availtgbot.billing import Billing, BillingItem
+
+
+URL = urlsplit("http://example.com/")
+
+
+def test_add_item_over_personal_quota(billing):
+    billing.add_session(1)
+    billing.update_user_quota(1, max_items=2)
+    billing.add_user_item(1, "a", URL, 10, 0)
+    billing.add_user_item(1, "b", URL, 10, 0)
+    with pytest.raises(Billing.ItemQuotaExceededError):
+        billing.add_user_item(1, "c", URL, 10, 0)
+    assert [x[0] for x in billing.get_user_items_list(1)] == ["a", "b"]
+
+
+def test_add_item_over_default_quota(db_path):
+    billing = Billing(db_path, max_items=1)
+    billing.add_session(1)
+    billing.add_user_item(1, "a", URL, 10, 0)
+    with pytest.raises(Billing.ItemQuotaExceededError):
+        billing.add_user_item(1, "b", URL, 10, 0)
+
+
+def test_zero_quota_is_not_treated_as_unset(db_path):
+    billing = Billing(db_path, max_items=0, max_checks_per_minute=0)
+    billing.add_session(1)
+    assert billing.get_user_quota(1) == (0, 0, 1)
+    with pytest.raises(Billing.ItemQuotaExceededError):
+        billing.add_user_item(1, "a", URL, 10, 0)
+
+
+def test_add_existing_name(billing):
+    billing.add_session(1)
+    billing.add_user_item(1, "a", URL, 10, 0)
+    with pytest.raises(Billing.MonitorItemNameExistsError):
+        billing.add_user_item(1, "a", URL, 10, 0)
+
+
+def test_item_queries(billing):
+    billing.add_session(1)
+    billing.add_user_item(1, "a", URL, 10, 0)
+    assert billing.item_exists(1, "a")
+    assert not billing.item_exists(1, "b")
+    assert not billing.item_exists(2, "a")
+    assert billing.get_user_items_list(1) == [("a", URL, 10)]
+
+    billing.update_user_item(1, "a", delay=20)
+    assert billing.get_user_items_list(1) == [("a", URL, 20)]
+
+    billing.remove_user_item(1, "a")
+    assert not billing.item_exists(1, "a")
+    with pytest.raises(Billing.MonitorItemNotFoundError):
+        billing.remove_user_item(1, "a")
+
+
+def test_large_user_id(billing):
+    user_id = -1001234567890
+    billing.add_session(user_id)
+    billing.add_user_item(user_id, "a", URL, 10, 0)
+    assert billing.item_exists(user_id, "a")
+
+
+def test_concurrent_adds_respect_quota(db_path):
+    billing = Billing(db_path, max_items=3)
+    billing.add_session(1)
+
+    def add(name):
+        try:
+            billing.add_user_item(1, name, URL, 10, 0)
+        except Billing.ItemQuotaExceededError:
+            pass
+
+    threads = [Thread(target=add, args=(str(x),)) for x in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(billing.get_user_items_list(1)) == 3
+
+
+def test_user_quotas(billing):
+    billing.add_session(1)
+    billing.add_session(2)
+    billing.update_user_quota(2, max_checks_per_minute=30, weight=2)
+    assert billing.get_user_quotas() == {
+        '1': (Billing.DEFAULT_MAX_ITEMS, Billing.DEFAULT_MAX_CHECKS_PER_MINUTE, 1),
+        '2': (Billing.DEFAULT_MAX_ITEMS, 30, 2),
+    }
+
+
+def _columns(table):
+    return {x['name'] for x in inspect(Billing.engine).get_columns(table)}
+
+
+def test_missing_columns_are_added(db_path):
+    # Tables as created by an older version, monitoritems also lacks reserved word "offset" column
+    engine = create_engine(db_path if "://" in db_path else "sqlite:///" + db_path)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE sessionstatus (id INTEGER PRIMARY KEY, user_id INTEGER, status INTEGER)"))
+        connection.execute(text("CREATE TABLE monitoritems (id INTEGER PRIMARY KEY, user_id VARCHAR, name VARCHAR," +
+                                " delay INTEGER)"))
+        connection.execute(text("INSERT INTO sessionstatus (id, user_id, status) VALUES (1, 1, 0)"))
+    engine.dispose()
+
+    billing = Billing(db_path)
+    assert billing.get_session(1).status == 0
+    assert billing.get_user_quota(1) == (Billing.DEFAULT_MAX_ITEMS, Billing.DEFAULT_MAX_CHECKS_PER_MINUTE, 1)
+    expected = {x.name: {c.name for c in x.columns} for x in BillingItem.metadata.sorted_tables}
+    for table, columns in expected.items():
+        assert _columns(table) == columns
+
+    # Running again on an up to date schema changes nothing
+    Billing._migrate()
+    for table, columns in expected.items():
+        assert _columns(table) == columns
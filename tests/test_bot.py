@@ -0,0 +1,13 @@
+from types import SimpleNamespace
+
+from availtgbot.bot import Bot
+
+
+def test_throttling_message(sqlite_path):
+    bot = Bot(token="123456:TEST", db_path=sqlite_path)
+    sent = []
+    bot.updater.bot = SimpleNamespace(sendMessage=lambda **kwargs: sent.append(kwargs))
+    bot._checks_throttled(1, 30)
+    assert sent[0]['chat_id'] == 1
+    assert "more than 30 checks per minute" in sent[0]['text']
+    assert "{}" not in sent[0]['text']
@@ -0,0 +1,42 @@
+from threading import Event
+import datetime
+
+import pytest
+
+from availtgbot.monitor import Monitor
+
+
+def _raise(*args):
+    raise RuntimeError("failure")
+
+
+def test_failed_round_is_logged(sqlite_path, monkeypatch):
+    monitor = Monitor(lambda *args: None, sqlite_path)
+    monkeypatch.setattr(monitor.billing, "get_due_items", _raise)
+    monitor._check_items()
+
+
+def test_failed_flush_keeps_results(sqlite_path, monkeypatch):
+    monitor = Monitor(lambda *args: None, sqlite_path)
+    update = (1, 200, datetime.datetime.now())
+    monitor.status_updates = [update]
+    monkeypatch.setattr(monitor.billing, "update_items_status", _raise)
+    monitor._flush_status_updates()
+    assert monitor.status_updates == [update]
+
+
+@pytest.mark.parametrize("handler_fails", [False, True])
+def test_throttle_handler_runs_outside_round(sqlite_path, monkeypatch, handler_fails):
+    called = Event()
+
+    def handler(user_id, max_checks_per_minute):
+        called.set()
+        if handler_fails:
+            raise RuntimeError("failure")
+
+    monitor = Monitor(lambda *args: None, sqlite_path, throttle_handler=handler)
+    monkeypatch.setattr(monitor.fair_scheduler, "throttled", {'1'})
+    monkeypatch.setattr(monitor.fair_scheduler, "dispatch", lambda quotas: [])
+    monitor._check_items()
+    assert called.wait(5)
+    assert monitor.throttled == {'1'}
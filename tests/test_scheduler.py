@@ -0,0 +1,141 @@
+from types import SimpleNamespace
+
+from availtgbot.monitor import FairScheduler
+
+
+def _items(user_id, count, start=0):
+    return [SimpleNamespace(id=start + x, user_id=user_id) for x in range(count)]
+
+
+def _enqueue(scheduler, items, due=100):
+    for item in items:
+        scheduler.enqueue(item, due)
+
+
+def _users(items):
+    return [str(x.user_id) for x in items]
+
+
+def test_capacity_caps_dispatch():
+    scheduler = FairScheduler(capacity=3)
+    _enqueue(scheduler, _items(1, 10))
+    assert len(scheduler.dispatch({}, now=100)) == 3
+    assert len(scheduler.dispatch({}, now=101)) == 3
+
+
+def test_unlimited_capacity_dispatches_everything():
+    scheduler = FairScheduler()
+    _enqueue(scheduler, _items(1, 10) + _items(2, 10, start=10))
+    assert len(scheduler.dispatch({}, now=100)) == 20
+
+
+def test_heavy_user_does_not_starve_light_user():
+    scheduler = FairScheduler(capacity=4)
+    _enqueue(scheduler, _items(1, 100))
+    _enqueue(scheduler, _items(2, 2, start=100))
+    dispatched = _users(scheduler.dispatch({}, now=100))
+    assert dispatched.count('2') == 2
+    assert dispatched.count('1') == 2
+
+
+def test_weighted_shares():
+    scheduler = FairScheduler(capacity=8)
+    _enqueue(scheduler, _items(1, 100))
+    _enqueue(scheduler, _items(2, 100, start=100))
+    quotas = {'1': (100, 1000, 3), '2': (100, 1000, 1)}
+    dispatched = _users(scheduler.dispatch(quotas, now=100))
+    assert dispatched.count('1') == 6
+    assert dispatched.count('2') == 2
+
+
+def test_checks_per_minute_limit_and_history_expiry():
+    scheduler = FairScheduler()
+    _enqueue(scheduler, _items(1, 10))
+    quotas = {'1': (100, 4, 1)}
+    assert len(scheduler.dispatch(quotas, now=100)) == 4
+    assert len(scheduler.dispatch(quotas, now=130)) == 0
+    assert scheduler.throttled == {'1'}
+    assert len(scheduler.dispatch(quotas, now=160)) == 4
+    assert len(scheduler.dispatch(quotas, now=221)) == 2
+    assert scheduler.throttled == set()
+
+
+def test_throttled_user_does_not_consume_capacity():
+    scheduler = FairScheduler(capacity=4)
+    _enqueue(scheduler, _items(1, 10))
+    _enqueue(scheduler, _items(2, 10, start=10))
+    quotas = {'1': (100, 1, 1), '2': (100, 100, 1)}
+    dispatched = _users(scheduler.dispatch(quotas, now=100))
+    assert dispatched.count('1') == 1
+    assert dispatched.count('2') == 3
+
+
+def test_rotation_alternates_first_served_user():
+    scheduler = FairScheduler(capacity=1)
+    _enqueue(scheduler, _items(1, 10))
+    _enqueue(scheduler, _items(2, 10, start=10))
+    dispatched = [_users(scheduler.dispatch({}, now=100 + x))[0] for x in range(4)]
+    assert dispatched == ['1', '2', '1', '2']
+
+
+def test_waiting_item_is_not_enqueued_twice():
+    scheduler = FairScheduler(capacity=1)
+    items = _items(1, 2)
+    _enqueue(scheduler, items)
+    _enqueue(scheduler, items, due=101)
+    assert scheduler.get_lag_stats(now=101)['1']['queued'] == 2
+
+
+def test_item_in_check_is_not_enqueued_until_complete():
+    scheduler = FairScheduler()
+    items = _items(1, 1)
+    _enqueue(scheduler, items)
+    assert len(scheduler.dispatch({}, now=100)) == 1
+    _enqueue(scheduler, items, due=101)
+    assert scheduler.dispatch({}, now=101) == []
+    scheduler.complete([items[0].id])
+    _enqueue(scheduler, items, due=102)
+    assert scheduler.dispatch({}, now=102) == items
+
+
+def test_lag_stats_report_starved_users():
+    scheduler = FairScheduler()
+    _enqueue(scheduler, _items(1, 3))
+    scheduler.dispatch({'1': (100, 1, 1)}, now=105)
+    stats = scheduler.get_lag_stats(now=110)['1']
+    assert stats['checks'] == 1
+    assert stats['last'] == 5
+    assert stats['queued'] == 2
+    assert stats['oldest'] == 10
+
+    scheduler = FairScheduler()
+    _enqueue(scheduler, _items(2, 1))
+    scheduler.dispatch({'2': (100, 0, 1)}, now=105)
+    stats = scheduler.get_lag_stats(now=120)['2']
+    assert stats['checks'] == 0
+    assert stats['queued'] == 1
+    assert stats['oldest'] == 20
+
+
+def test_default_quota_applies_to_users_without_quota():
+    scheduler = FairScheduler(default_quota=(100, 2, 1))
+    _enqueue(scheduler, _items(1, 5))
+    assert len(scheduler.dispatch({}, now=100)) == 2
+    assert scheduler.throttled == {'1'}
+
+
+def test_zero_capacity_dispatches_nothing():
+    scheduler = FairScheduler(capacity=0)
+    _enqueue(scheduler, _items(1, 5))
+    assert scheduler.dispatch({}, now=100) == []
+
+
+def test_retain_drops_removed_items():
+    scheduler = FairScheduler()
+    items = _items(1, 3)
+    _enqueue(scheduler, items)
+    assert sorted(scheduler.get_queued_ids()) == [0, 1, 2]
+    scheduler.retain({0, 2})
+    assert scheduler.dispatch({}, now=100) == [items[0], items[2]]
+    _enqueue(scheduler, items[1:2], due=101)
+    assert scheduler.get_queued_ids() == [1]
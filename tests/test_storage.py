@@ -0,0 +1,77 @@
+from urllib.parse import urlsplit
+import datetime
+
+from sqlalchemy import text
+
+from availtgbot import storage
+from availtgbot.billing import Billing
+
+
+URL = urlsplit("http://example.com/")
+
+
+def _add_items(billing):
+    billing.add_session(1)
+    billing.add_user_item(1, "every10", URL, 10, 0)
+    billing.add_user_item(1, "every10shifted", URL, 10, 5)
+    billing.add_user_item(1, "every7", URL, 7, 0)
+
+
+def _names(items):
+    return sorted(x.name for x in items)
+
+
+def test_sqlite_file_database_uses_wal(sqlite_path):
+    Billing(sqlite_path)
+    with Billing.engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+
+def test_create_storage():
+    assert isinstance(storage.create_storage(":memory:"), storage.SQLiteStorage)
+    assert isinstance(storage.create_storage("sqlite:///"), storage.SQLiteStorage)
+
+
+def test_create_postgres_storage(postgres_url):
+    assert isinstance(storage.create_storage(postgres_url), storage.PostgresStorage)
+
+
+def test_fetch_due_items(billing):
+    _add_items(billing)
+    assert _names(billing.get_due_items(1000)) == ["every10"]
+    assert _names(billing.get_due_items(1005)) == ["every10shifted"]
+    assert _names(billing.get_due_items(1002)) == []
+    assert _names(billing.get_due_items(1050)) == ["every10", "every7"]
+
+
+def test_due_items_are_claimed_once(db_path, billing):
+    _add_items(billing)
+    # Separate storage with its own pool stands for another bot process
+    other = storage.create_storage(db_path)
+    try:
+        assert _names(billing.get_due_items(1000)) == ["every10"]
+        assert _names(other.fetch_due_items(1000)) == []
+        assert _names(billing.get_due_items(1000)) == []
+        assert _names(other.fetch_due_items(1010)) == ["every10"]
+    finally:
+        other.engine.dispose()
+
+
+def test_apply_status_updates(billing):
+    _add_items(billing)
+    items = {x.name: x.id for x in billing.get_due_items(1050)}
+    check_time = datetime.datetime(2020, 1, 1, 12, 0)
+    billing.update_items_status([(items["every10"], 200, check_time), (items["every7"], 0, check_time)])
+    assert sorted(billing.get_user_items_status(1)) == [
+        ("every10", 200, check_time),
+        ("every10shifted", 0, None),
+        ("every7", 0, check_time),
+    ]
+
+
+def test_apply_status_updates_for_removed_item(billing):
+    _add_items(billing)
+    item_id = billing.get_due_items(1000)[0].id
+    billing.remove_user_item(1, "every10")
+    billing.update_items_status([(item_id, 200, datetime.datetime.now())])
+    billing.update_items_status([])